@@ -4,95 +4,219 @@ import pycountry
 import plotly.express as px
 import plotly.graph_objects as go
 import unicodedata
+import io
+import html
+import re
+from functools import partial
 import numpy as np
-from fuzzywuzzy import fuzz
+from rapidfuzz import fuzz, process
 
 # Set the correct password
 CORRECT_PASSWORD = "1992"
 
+# Precompiled once so the vectorized name cleaning doesn't recompile per call
+WHITESPACE_PATTERN = re.compile(r"\s+")
+NON_ALNUM_PATTERN = re.compile(r"[\W_]+")
+# Single-pass removal of zero-width/BOM characters and non-breaking spaces
+INVISIBLE_CHARS_TABLE = str.maketrans({"\u200b": "", "\uFEFF": "", "\xa0": " "})
+
+# Figure dicts kept per builder; older datasets/variables/schemes are evicted
+FIGURE_CACHE_ENTRIES = 32
+
+# Parsed uploads kept in memory (each new upload has its own file_id), and for
+# how long in seconds
+UPLOAD_CACHE_ENTRIES = 8
+UPLOAD_CACHE_TTL = 3600
+
+# Aggregation method -> (groupby function, suffix of the aggregated column)
+AGGREGATIONS = {
+    "Total Sum": ("sum", "total"),
+    "Average": ("mean", "avg"),
+    "Maximum Value": ("max", "max"),
+}
+
+# Row styles for the top three ranks (gold, silver, bronze)
+RANK_HIGHLIGHTS = {
+    1: 'background-color: #FFD700; font-weight: bold',
+    2: 'background-color: #C0C0C0; font-weight: bold',
+    3: 'background-color: #CD7F32; font-weight: bold',
+}
+
+# Column names recognised as the time dimension of panel data
+TIME_COLUMNS = frozenset({'year', 'time', 'date', 'period'})
+
+# Hard overrides for common country-name variations (lowercased input -> alpha_3)
+COUNTRY_OVERRIDES = {
+    "turkey": "TUR", "türkiye": "TUR", "turkiye": "TUR",
+    "usa": "USA", "us": "USA", "united states": "USA",
+    "uk": "GBR", "united kingdom": "GBR", "britain": "GBR",
+    "south korea": "KOR", "korea": "KOR", "rok": "KOR",
+    "north korea": "PRK", "dprk": "PRK",
+    "russia": "RUS", "russian federation": "RUS", "ussr": "RUS",
+    "china": "CHN", "prc": "CHN",
+    "vietnam": "VNM", "viet nam": "VNM",
+    "czech republic": "CZE", "czechia": "CZE",
+    "uae": "ARE", "united arab emirates": "ARE",
+    "drc": "COD", "dr congo": "COD", "democratic republic of the congo": "COD",
+    "congo": "COG", "republic of the congo": "COG",
+    "ivory coast": "CIV", "cote d'ivoire": "CIV",
+    "myanmar": "MMR", "burma": "MMR",
+    "palestine": "PSE", "palestinian territory": "PSE",
+    "tanzania": "TZA", "united republic of tanzania": "TZA",
+    "bolivia": "BOL", "plurinational state of bolivia": "BOL",
+    "venezuela": "VEN", "bolivarian republic of venezuela": "VEN",
+    "iran": "IRN", "islamic republic of iran": "IRN",
+    "syria": "SYR", "syrian arab republic": "SYR",
+    "laos": "LAO", "lao people's democratic republic": "LAO",
+    "moldova": "MDA", "republic of moldova": "MDA",
+    "macedonia": "MKD", "north macedonia": "MKD",
+    "netherlands": "NLD", "holland": "NLD",
+    "swaziland": "SWZ", "eswatini": "SWZ"
+}
+
 # ============================================================
-# ENHANCED COUNTRY NORMALIZATION WITH FUZZY MATCHING
+# COUNTRY LOOKUP INDEX (built once per process)
 # ============================================================
-def normalize_country(name: str):
+@st.cache_resource
+def build_country_index():
     """
-    Enhanced country name normalization with fuzzy matching.
-    Returns: (alpha_3, alpha_2, official_name)
+    Map every lowercased pycountry name and code, plus COUNTRY_OVERRIDES,
+    to (alpha_3, alpha_2, name).
+    Cached as a resource so Streamlit reruns reuse the same dict.
     """
-    if pd.isna(name) or str(name).strip() == "":
-        return None, None, None
-    
-    # 1. Clean the input
-    clean = unicodedata.normalize("NFKD", str(name)).strip()
-    clean = clean.replace("\u200b", "").replace("\uFEFF", "").replace("\xa0", " ")
-    clean = " ".join(clean.split())  # Remove extra whitespace
+    index = {}
+    # Overrides are inserted first so they win over pycountry's own names
+    for alias, alpha_3 in COUNTRY_OVERRIDES.items():
+        country = pycountry.countries.get(alpha_3=alpha_3)
+        if country is not None:
+            index[unicodedata.normalize("NFKD", alias)] = (country.alpha_3, country.alpha_2, country.name)
     
-    # 2. Hard overrides for common variations
-    overrides = {
-        "turkey": "TUR", "türkiye": "TUR", "turkiye": "TUR",
-        "usa": "USA", "us": "USA", "united states": "USA",
-        "uk": "GBR", "united kingdom": "GBR", "britain": "GBR",
-        "south korea": "KOR", "korea": "KOR", "rok": "KOR",
-        "north korea": "PRK", "dprk": "PRK",
-        "russia": "RUS", "russian federation": "RUS", "ussr": "RUS",
-        "china": "CHN", "prc": "CHN",
-        "vietnam": "VNM", "viet nam": "VNM",
-        "czech republic": "CZE", "czechia": "CZE",
-        "uae": "ARE", "united arab emirates": "ARE",
-        "drc": "COD", "dr congo": "COD", "democratic republic of the congo": "COD",
-        "congo": "COG", "republic of the congo": "COG",
-        "ivory coast": "CIV", "cote d'ivoire": "CIV",
-        "myanmar": "MMR", "burma": "MMR",
-        "palestine": "PSE", "palestinian territory": "PSE",
-        "tanzania": "TZA", "united republic of tanzania": "TZA",
-        "bolivia": "BOL", "plurinational state of bolivia": "BOL",
-        "venezuela": "VEN", "bolivarian republic of venezuela": "VEN",
-        "iran": "IRN", "islamic republic of iran": "IRN",
-        "syria": "SYR", "syrian arab republic": "SYR",
-        "laos": "LAO", "lao people's democratic republic": "LAO",
-        "moldova": "MDA", "republic of moldova": "MDA",
-        "macedonia": "MKD", "north macedonia": "MKD",
-        "netherlands": "NLD", "holland": "NLD",
-        "swaziland": "SWZ", "eswatini": "SWZ"
-    }
-    
-    clean_lower = clean.lower()
-    if clean_lower in overrides:
-        try:
-            country = pycountry.countries.get(alpha_3=overrides[clean_lower])
-            return country.alpha_3, country.alpha_2, country.name
-        except:
-            pass
-    
-    # 3. Try exact pycountry lookup
-    try:
-        country = pycountry.countries.lookup(clean)
-        return country.alpha_3, country.alpha_2, country.name
-    except:
-        pass
-    
-    # 4. Fuzzy matching with all country names
-    best_match = None
-    best_score = 0
+    for country in pycountry.countries:
+        record = (country.alpha_3, country.alpha_2, country.name)
+        for attr in ("alpha_2", "alpha_3", "numeric", "name", "official_name", "common_name"):
+            value = getattr(country, attr, None)
+            if value:
+                # Keys use the same NFKD form as the cleaned input names
+                index.setdefault(unicodedata.normalize("NFKD", value).lower(), record)
+    return index
+
+@st.cache_resource
+def build_compact_index():
+    """
+    Map punctuation/space-free forms of country names ("cotedivoire",
+    "korearepublicof") and COUNTRY_OVERRIDES aliases to (alpha_3, alpha_2, name).
+    ISO codes are left out: stripped placeholders such as "N/A" or "No." would
+    otherwise land on a 2-letter code (Namibia, Norway).
+    """
+    index = {}
+    for alias, alpha_3 in COUNTRY_OVERRIDES.items():
+        country = pycountry.countries.get(alpha_3=alpha_3)
+        if country is not None:
+            key = NON_ALNUM_PATTERN.sub("", unicodedata.normalize("NFKD", alias))
+            index[key] = (country.alpha_3, country.alpha_2, country.name)
     
     for country in pycountry.countries:
-        # Check official name
-        score = fuzz.ratio(clean_lower, country.name.lower())
-        if score > best_score:
-            best_score = score
-            best_match = country
-        
-        # Check common name if available
+        record = (country.alpha_3, country.alpha_2, country.name)
+        for attr in ("name", "official_name", "common_name"):
+            value = getattr(country, attr, None)
+            if value:
+                key = NON_ALNUM_PATTERN.sub("", unicodedata.normalize("NFKD", value).lower())
+                index.setdefault(key, record)
+    return index
+
+@st.cache_resource
+def build_fuzzy_choices():
+    """
+    Lowercased official and common names for fuzzy matching, with a parallel
+    list of (alpha_3, alpha_2, name) records.
+    """
+    choices, records = [], []
+    for country in pycountry.countries:
+        record = (country.alpha_3, country.alpha_2, country.name)
+        choices.append(country.name.lower())
+        records.append(record)
         if hasattr(country, 'common_name'):
-            score = fuzz.ratio(clean_lower, country.common_name.lower())
-            if score > best_score:
-                best_score = score
-                best_match = country
+            choices.append(country.common_name.lower())
+            records.append(record)
+    return choices, records
+
+# ============================================================
+# ENHANCED COUNTRY NORMALIZATION WITH FUZZY MATCHING
+# ============================================================
+def normalize_countries(clean_names):
+    """
+    Enhanced country name normalization with fuzzy matching, for a list of names
+    already cleaned by resolve_countries (NFKD, invisible characters stripped,
+    whitespace collapsed, lowercased) that missed the exact index.
+    All names are scored against every choice in one rapidfuzz cdist call.
+    Returns: list of (alpha_3, alpha_2, official_name)
+    """
+    choices, records = build_fuzzy_choices()
+    # Scores below the 80% cutoff come back as 0
+    scores = process.cdist(
+        clean_names, choices, scorer=fuzz.ratio, score_cutoff=80,
+        dtype=np.float32, workers=-1
+    )
+    best = scores.argmax(axis=1)
+    best_scores = scores[np.arange(len(clean_names)), best]
+    return [
+        records[choice] if score else (None, None, None)
+        for choice, score in zip(best, best_scores)
+    ]
+
+@st.cache_data(show_spinner=False)
+def resolve_names(names):
+    """
+    Resolve a tuple of distinct country names to ISO codes and official names:
+    exact matches are a vectorized dict map, only misses go through
+    normalize_countries.
+    Cached on the names themselves, which is an exact key (a large Series
+    argument would only be hashed from a sample of its rows).
+    Returns: DataFrame with one row per name plus a trailing empty row
+    """
+    # Clean all distinct names at once with vectorized string methods
+    keys = (
+        pd.Series(names, dtype=object).astype(str)
+        .str.normalize("NFKD")
+        .str.translate(INVISIBLE_CHARS_TABLE)
+        .str.replace(WHITESPACE_PATTERN, " ", regex=True)
+        .str.strip()
+        .str.lower()
+    )
+    resolved = keys.map(build_country_index()).astype(object)
+    misses = resolved.isna()
+    if misses.any():
+        # Retry misses on their punctuation-free form before fuzzy matching
+        compact_keys = keys[misses].str.replace(NON_ALNUM_PATTERN, "", regex=True)
+        resolved[misses] = compact_keys.map(build_compact_index()).astype(object)
+        misses = resolved.isna()
+    if misses.any():
+        miss_keys = keys[misses]
+        resolved[misses] = pd.Series(normalize_countries(miss_keys.tolist()), index=miss_keys.index)
     
-    # Accept matches with 80%+ similarity
-    if best_match and best_score >= 80:
-        return best_match.alpha_3, best_match.alpha_2, best_match.name
+    # The trailing empty row is picked up by missing names (factorize code -1)
+    return pd.DataFrame(
+        resolved.tolist() + [(None, None, None)],
+        columns=['iso3', 'iso2_label', 'country_name_official']
+    )
+
+def resolve_countries(countries):
+    """
+    Resolve a Series of country names to ISO codes and official names.
+    Each distinct name is resolved once through the cached resolve_names (panel
+    data repeats names per period) and expanded back to every row with take().
+    Returns: DataFrame with iso3, iso2_label and country_name_official columns
+    """
+    codes, names = pd.factorize(countries)
+    table = resolve_names(tuple(names))
+    resolved_rows = table.take(codes)
+    resolved_rows.index = countries.index
     
-    return None, None, None
+    # iso3 is the aggregation key: make it categorical straight from the codes
+    # above, so groupby works on integer codes without hashing strings again
+    iso3_codes, iso3_categories = pd.factorize(table['iso3'], sort=True)
+    resolved_rows['iso3'] = pd.Categorical.from_codes(iso3_codes[codes], categories=iso3_categories)
+    return resolved_rows
 
 # ============================================================
 # PASSWORD CHECK
@@ -108,74 +232,254 @@ def check_password():
         st.error("🚨 Incorrect password.")
     return False
 
+# ============================================================
+# DATA LOADING
+# ============================================================
+@st.cache_data(show_spinner=False, max_entries=UPLOAD_CACHE_ENTRIES, ttl=UPLOAD_CACHE_TTL)
+def load_data(file_id, file_name, _file_bytes):
+    """
+    Parse an uploaded CSV/Excel file, cached on the upload's file_id.
+    The leading underscore keeps Streamlit from re-hashing the raw bytes on
+    every rerun; a new upload always gets a new file_id.
+    """
+    if file_name.endswith(".csv"):
+        # Multithreaded Arrow tokenizer for every file size, falling back to the C parser
+        try:
+            return pd.read_csv(io.BytesIO(_file_bytes), encoding='utf-8', engine='pyarrow')
+        except (ImportError, ValueError):
+            # Single-pass type inference avoids mixed-dtype columns on the C parser
+            return pd.read_csv(io.BytesIO(_file_bytes), encoding='utf-8', low_memory=False)
+    
+    # Rust-backed calamine reader, falling back to openpyxl/xlrd
+    try:
+        return pd.read_excel(io.BytesIO(_file_bytes), engine='calamine')
+    except (ImportError, ValueError):
+        return pd.read_excel(io.BytesIO(_file_bytes))
+
 # ============================================================
 # DATA CLEANING FUNCTION
 # ============================================================
 def clean_numeric_data(df, variable):
     """Ensure numeric data is properly formatted"""
-    df_clean = df.copy()
-    
     # Convert variable to numeric, handling errors
-    df_clean[variable] = pd.to_numeric(df_clean[variable], errors='coerce')
-    
-    # Remove any infinite values
-    df_clean = df_clean[~df_clean[variable].isin([np.inf, -np.inf])]
-    
-    # Remove NaN values in the variable
-    df_clean = df_clean.dropna(subset=[variable])
+    values = pd.to_numeric(df[variable], errors='coerce')
     
-    return df_clean
+    # Remove infinite and NaN values in one row filter, the only copy made
+    keep = np.isfinite(values.to_numpy(dtype=np.float64, na_value=np.nan))
+    return df.loc[keep].assign(**{variable: values[keep]})
+
+# ============================================================
+# DATA EXPORT
+# ============================================================
+def to_csv_bytes(df):
+    """UTF-8 CSV bytes for download, encoded by pandas straight into a byte buffer."""
+    buffer = io.BytesIO()
+    df.to_csv(buffer, index=False, encoding='utf-8')
+    return buffer.getvalue()
 
 # ============================================================
 # CORRECT AGGREGATION FUNCTIONS
 # ============================================================
-def aggregate_data(df, variable, aggregation_method):
+def aggregate_data(df, variable, aggregation_method, time_col):
+    """
+    Aggregate country-resolved panel data to one row per ISO-3 code.
+    time_col is the panel's time column, as detected by the caller.
+    Returns: (aggregated DataFrame, name of the value column)
+    """
+    if aggregation_method == "Latest Year":
+        # Find the latest year for each country (whole rows are kept)
+        latest_indices = df.groupby('iso3', observed=True, sort=False)[time_col].idxmax()
+        aggregated = df.loc[latest_indices].reset_index(drop=True)
+        return aggregated, variable
+    
+    # One groupby pass computes the value and carries the country labels along
+    func, suffix = AGGREGATIONS[aggregation_method]
+    value_col = f'{variable}_{suffix}'
+    aggregated = df.groupby('iso3', as_index=False, observed=True, sort=False).agg(**{
+        value_col: (variable, func),
+        'country': ('country', 'first'),
+        'iso2_label': ('iso2_label', 'first'),
+        'country_name_official': ('country_name_official', 'first'),
+    })
+    return aggregated[['country', value_col, 'iso3', 'iso2_label', 'country_name_official']], value_col
+
+# ============================================================
+# SUMMARY STATISTICS
+# ============================================================
+@st.cache_data(show_spinner=False)
+def summarize_variable(values):
+    """
+    Mean/median/std in one agg call plus the index labels of the extreme values,
+    cached on the column contents.
+    """
+    stats = values.agg(['mean', 'median', 'std']).to_dict()
+    stats['idxmax'] = values.idxmax()
+    stats['idxmin'] = values.idxmin()
+    return stats
+
+# ============================================================
+# FIGURE BUILDERS
+# ============================================================
+def plot_values(values):
+    """
+    Values as sent to the browser, never rounded. float32 halves the JSON payload
+    and keeps ~7 significant digits of every value, small ones included; it is
+    used while that still covers the 2 decimals shown for the largest value.
     """
-    CORRECT aggregation function
+    z = np.asarray(values, dtype=np.float64)
+    if len(z) and np.abs(z).max() < 1e4:
+        z = z.astype(np.float32)
+    return z
+
+@st.cache_data(show_spinner=False, max_entries=FIGURE_CACHE_ENTRIES)
+def build_choropleth(iso3, names, values, value_label, color_scheme, title):
+    """
+    Build the choropleth from hashable tuples of the mapped columns.
+    Returns the figure as a dict so each rerun wraps a fresh go.Figure around it.
     """
-    # Make a copy to avoid modifying original
-    df_work = df.copy()
+    # A go.Choropleth built straight from the tuples skips px's dataframe and
+    # hover_data processing; the hover text and colour bar match what px produced
+    fig = go.Figure(go.Choropleth(
+        locations=iso3,
+        locationmode="ISO-3",
+        z=plot_values(values),
+        hovertext=names,
+        coloraxis='coloraxis',
+        hovertemplate=f"<b>%{{hovertext}}</b><br><br>{value_label}=%{{z:.2f}}<extra></extra>"
+    ))
+
+    fig.update_geos(
+        projection_type="natural earth",
+        showcountries=True,
+        countrycolor="lightgray",
+        showcoastlines=True,
+        coastlinecolor="darkgray",
+        bgcolor='#f0f2f6'
+    )
+
+    fig.update_layout(
+        title={
+            'text': title,
+            'x': 0.5,
+            'xanchor': 'center',
+            'font': {'size': 20}
+        },
+        coloraxis=dict(colorscale=color_scheme, colorbar=dict(title=dict(text=value_label))),
+        height=600,
+        margin=dict(l=0, r=0, t=50, b=0)
+    )
     
-    if aggregation_method == "Total Sum":
-        # Simple groupby and sum - CORRECTED
-        aggregated = df_work.groupby('country', as_index=False).agg({
-            variable: 'sum'
-        })
-        aggregated.rename(columns={variable: f'{variable}_total'}, inplace=True)
-        return aggregated, f'{variable}_total'
+    return fig.to_dict()
+
+@st.cache_data(show_spinner=False, max_entries=FIGURE_CACHE_ENTRIES)
+def build_bar_chart(names, values, value_label, color_scheme, title):
+    """Horizontal bar chart of the top countries, cached like build_choropleth."""
+    x = plot_values(values)
     
-    elif aggregation_method == "Average":
-        # Group by country and calculate mean
-        aggregated = df_work.groupby('country', as_index=False).agg({
-            variable: 'mean'
-        })
-        aggregated.rename(columns={variable: f'{variable}_avg'}, inplace=True)
-        return aggregated, f'{variable}_avg'
+    # A single go.Bar sharing a continuous coloraxis looks the same as px.bar
+    # with color=..., without px's dataframe introspection
+    fig_bar = go.Figure(go.Bar(
+        x=x,
+        y=names,
+        orientation='h',
+        marker=dict(color=x, coloraxis='coloraxis'),
+        text=x,
+        hovertemplate=f"{value_label}=%{{x}}<br>Country=%{{y}}<extra></extra>"
+    ))
     
-    elif aggregation_method == "Maximum Value":
-        # Group by country and get max value
-        aggregated = df_work.groupby('country', as_index=False).agg({
-            variable: 'max'
-        })
-        aggregated.rename(columns={variable: f'{variable}_max'}, inplace=True)
-        return aggregated, f'{variable}_max'
+    fig_bar.update_traces(texttemplate='%{text:.2f}', textposition='outside')
+    fig_bar.update_layout(
+        coloraxis=dict(colorscale=color_scheme, colorbar=dict(title=dict(text=value_label))),
+        yaxis={'categoryorder': 'total ascending'},
+        height=max(400, len(names) * 30),
+        showlegend=False,
+        title={'text': title, 'x': 0.5, 'xanchor': 'center'},
+        xaxis_title=value_label,
+        yaxis_title=''
+    )
     
-    elif aggregation_method == "Latest Year":
-        # Get the most recent year for each country
-        time_col = [col for col in df_work.columns if col.lower() in ['year', 'time', 'date', 'period']][0]
-        # Find the latest year for each country
-        latest_indices = df_work.groupby('country')[time_col].idxmax()
-        aggregated = df_work.loc[latest_indices].reset_index(drop=True)
-        return aggregated, variable
+    return fig_bar.to_dict()
+
+@st.cache_data(show_spinner=False, max_entries=FIGURE_CACHE_ENTRIES)
+def build_histogram(values, display_variable, value_label, title):
+    """Distribution histogram with mean/median markers, cached like build_choropleth."""
+    # Full-precision values: the browser bins these, and float32 could move a
+    # value across a bin edge or off the mean/median lines computed below
+    df_hist = pd.DataFrame({display_variable: np.asarray(values, dtype=np.float64)})
+    
+    fig_hist = px.histogram(
+        df_hist,
+        x=display_variable,
+        nbins=30,
+        color_discrete_sequence=['#636EFA'],
+        labels={display_variable: value_label}
+    )
+    
+    fig_hist.update_layout(
+        title={'text': title, 'x': 0.5, 'xanchor': 'center'},
+        xaxis_title=value_label,
+        yaxis_title='Frequency (Number of Countries)',
+        height=400,
+        showlegend=False
+    )
+    
+    # Add vertical lines for mean and median
+    mean_val = np.mean(values)
+    median_val = np.median(values)
+    
+    fig_hist.add_vline(x=mean_val, line_dash="dash", line_color="red", 
+                      annotation_text=f"Mean: {mean_val:.2f}", 
+                      annotation_position="top")
+    fig_hist.add_vline(x=median_val, line_dash="dash", line_color="green", 
+                      annotation_text=f"Median: {median_val:.2f}", 
+                      annotation_position="bottom")
+    
+    return fig_hist.to_dict()
+
+# ============================================================
+# MAP RENDERING
+# ============================================================
+def render_map(df_clean, display_variable, value_label, color_scheme, title, label_style):
+    """
+    Draw the choropleth from the cached figure, plus optional country labels.
+    label_style is (color, size), or None to hide labels.
+    """
+    st.markdown("---")
+    st.markdown("## 🌍 Choropleth Map")
+    
+    fig = go.Figure(build_choropleth(
+        tuple(df_clean["iso3"]),
+        tuple(df_clean["country_name_official"]),
+        tuple(df_clean[display_variable]),
+        value_label,
+        color_scheme,
+        title
+    ))
+
+    # Add country labels only if requested (one trace for all countries)
+    if label_style:
+        label_color, label_size = label_style
+        fig.add_scattergeo(
+            locations=df_clean["iso3"].tolist(),
+            text=df_clean["iso2_label"].tolist(),
+            mode="text",
+            textposition="middle center",
+            textfont=dict(color=label_color, size=label_size),
+            showlegend=False,
+            hoverinfo='skip'
+        )
+
+    st.plotly_chart(fig, use_container_width=True)
 
 # ============================================================
 # CALCULATION VERIFICATION
 # ============================================================
-def verify_calculations(df, variable, country_name="France"):
+def verify_calculations(df, variable, iso3="FRA", country_name="France"):
     """
-    Verify calculations for a specific country
+    Verify calculations for a specific country, selected by ISO-3 code so every
+    spelling pooled by aggregate_data (e.g. "France", "FR", "FRA") is included
     """
-    country_data = df[df['country'] == country_name]
+    country_data = df[df['iso3'] == iso3]
     if country_data.empty:
         return f"No data found for {country_name}", pd.DataFrame()
     
@@ -225,37 +529,33 @@ if check_password():
     if file:
         # Load data
         try:
-            if file.name.endswith(".csv"):
-                df = pd.read_csv(file, encoding='utf-8')
-            else:
-                df = pd.read_excel(file)
+            df = load_data(file.file_id, file.name, file.getvalue())
         except Exception as e:
             st.error(f"Error loading file: {e}")
             st.stop()
 
-        # Check for country column (case-insensitive)
-        country_col = None
-        for col in df.columns:
-            if col.lower() == 'country':
-                country_col = col
-                break
+        # Case-folded column names, matched once for the country and time columns
+        lower_cols = df.columns.astype(str).str.lower()
         
-        if not country_col:
+        # Check for country column (case-insensitive)
+        country_matches = np.flatnonzero(lower_cols == 'country')
+        if not len(country_matches):
             st.error("❌ Dataset must contain a 'country' column.")
             st.stop()
 
         # Normalize country column name
+        country_col = df.columns[country_matches[0]]
         if country_col != 'country':
             df = df.rename(columns={country_col: 'country'})
 
         st.success(f"✅ Loaded {len(df)} observations")
 
         # Check if panel data (has year/time column)
-        time_cols = [col for col in df.columns if col.lower() in ['year', 'time', 'date', 'period']]
+        time_cols = df.columns[lower_cols.isin(TIME_COLUMNS)].tolist()
         is_panel = len(time_cols) > 0
         
         # Select variable FIRST for all cases
-        numeric_cols = df.select_dtypes(include=["float64", "int64"]).columns.tolist()
+        numeric_cols = df.select_dtypes(include="number").columns.tolist()
         numeric_cols = [col for col in numeric_cols if col not in ['iso3', 'iso2_label']]
 
         if not numeric_cols:
@@ -267,6 +567,11 @@ if check_password():
         # Clean numeric data - IMPORTANT STEP
         df = clean_numeric_data(df, variable)
         
+        # Normalize countries up front, so panel aggregation pools spelling
+        # variants of the same country (e.g. "Germany" and "DE") under one ISO-3 code
+        with st.spinner("🔍 Normalizing country names..."):
+            df[['iso3', 'iso2_label', 'country_name_official']] = resolve_countries(df["country"])
+        
         if is_panel:
             time_col = time_cols[0]
             st.info(f"📊 Panel data detected (Time variable: **{time_col}**)")
@@ -288,36 +593,23 @@ if check_password():
             
             # Aggregate data based on selected method
             with st.spinner(f"🔄 Calculating {aggregation_method.lower()} for {variable}..."):
-                df_aggregated, display_variable = aggregate_data(df, variable, aggregation_method)
-                
-            # Normalize countries on aggregated data
-            with st.spinner("🔍 Normalizing country names..."):
-                df_aggregated[['iso3', 'iso2_label', 'country_name_official']] = df_aggregated["country"].apply(
-                    lambda x: pd.Series(normalize_country(x))
+                df_clean, display_variable = aggregate_data(
+                    df.dropna(subset=["iso3"]), variable, aggregation_method, time_col
                 )
             
-            df_clean = df_aggregated.dropna(subset=["iso3"]).copy()
-            
         else:
             # Cross-sectional data
             aggregation_method = "Single Period"
             display_variable = variable
-            df_clean = df.copy()
-            
-            # Normalize countries
-            with st.spinner("🔍 Normalizing country names..."):
-                df_clean[['iso3', 'iso2_label', 'country_name_official']] = df_clean["country"].apply(
-                    lambda x: pd.Series(normalize_country(x))
-                )
-            df_clean = df_clean.dropna(subset=["iso3"]).copy()
+            df_clean = df.dropna(subset=["iso3"])
 
-        # Check unresolved countries
-        unresolved = df_clean[df_clean["iso3"].isna()]["country"].unique().tolist()
+        # Check unresolved countries on the resolved frame, before rows without
+        # an ISO-3 code were dropped from df_clean
+        unresolved = df.loc[df["iso3"].isna(), "country"].dropna().unique().tolist()
         if unresolved:
             with st.expander(f"⚠️ {len(unresolved)} Unrecognized Countries - Click to View"):
                 st.warning("The following countries could not be matched:")
-                for country in unresolved:
-                    st.write(f"- {country}")
+                st.markdown("\n".join(f"- {country}" for country in unresolved))
                 st.info("💡 Tip: Check spelling or use standard country names")
 
         if df_clean.empty:
@@ -328,7 +620,7 @@ if check_password():
 
         # CALCULATION VERIFICATION SECTION
         if is_panel and st.checkbox("🔍 Verify Calculations for France"):
-            verification, raw_data = verify_calculations(df, variable, "France")
+            verification, raw_data = verify_calculations(df, variable, "FRA", "France")
             st.markdown(verification)
             
             if 'year' in raw_data.columns:
@@ -336,17 +628,6 @@ if check_password():
                 st.write("**Raw data for France:**")
                 st.dataframe(france_data.style.format({variable: "{:,.2f}"}))
 
-        # Color scheme selection
-        color_schemes = ['Viridis', 'Plasma', 'Inferno', 'Magma', 'Blues', 'Reds', 'YlOrRd', 'RdYlGn']
-        color_scheme = st.selectbox("🎨 Color scheme:", color_schemes, index=2)
-
-        st.markdown("---")
-
-        # ============================================================
-        # CHOROPLETH MAP
-        # ============================================================
-        st.markdown("## 🌍 Choropleth Map")
-        
         # Create appropriate title based on aggregation method
         if is_panel:
             if aggregation_method == "Total Sum":
@@ -360,53 +641,23 @@ if check_password():
         else:
             title_suffix = ""
         
-        fig = px.choropleth(
+        # ============================================================
+        # CHOROPLETH MAP
+        # ============================================================
+        # Chosen in the main script so the map and the bar chart always share it
+        color_schemes = ['Viridis', 'Plasma', 'Inferno', 'Magma', 'Blues', 'Reds', 'YlOrRd', 'RdYlGn']
+        color_scheme = st.selectbox("🎨 Color scheme:", color_schemes, index=2)
+        
+        value_label = f"{variable.replace('_', ' ').title()} ({aggregation_method})"
+        render_map(
             df_clean,
-            locations="iso3",
-            color=display_variable,
-            hover_name="country_name_official",
-            hover_data={
-                display_variable: ':.2f',
-                'iso3': False,
-            },
-            projection="natural earth",
-            color_continuous_scale=color_scheme,
-            labels={display_variable: f"{variable.replace('_', ' ').title()} ({aggregation_method})"}
-        )
-
-        fig.update_geos(
-            showcountries=True,
-            countrycolor="lightgray",
-            showcoastlines=True,
-            coastlinecolor="darkgray",
-            bgcolor='#f0f2f6'
-        )
-
-        # Add country labels only if requested
-        if show_labels:
-            for _, row in df_clean.iterrows():
-                fig.add_scattergeo(
-                    locations=[row["iso3"]],
-                    text=row["iso2_label"],
-                    mode="text",
-                    textfont=dict(color=label_color, size=label_size),
-                    showlegend=False,
-                    hoverinfo='skip'
-                )
-
-        fig.update_layout(
-            title={
-                'text': f'{variable.replace("_", " ").title()}{title_suffix}',
-                'x': 0.5,
-                'xanchor': 'center',
-                'font': {'size': 20}
-            },
-            height=600,
-            margin=dict(l=0, r=0, t=50, b=0)
+            display_variable,
+            value_label,
+            color_scheme,
+            f'{variable.replace("_", " ").title()}{title_suffix}',
+            (label_color, label_size) if show_labels else None
         )
 
-        st.plotly_chart(fig, use_container_width=True)
-
         st.markdown("---")
 
         # ============================================================
@@ -414,13 +665,15 @@ if check_password():
         # ============================================================
         st.markdown("## 📊 Statistical Summary")
         
+        summary = summarize_variable(df_clean[display_variable])
+        
         col1, col2, col3, col4 = st.columns(4)
         with col1:
-            st.metric("Mean", f"{df_clean[display_variable].mean():.2f}")
+            st.metric("Mean", f"{summary['mean']:.2f}")
         with col2:
-            st.metric("Median", f"{df_clean[display_variable].median():.2f}")
+            st.metric("Median", f"{summary['median']:.2f}")
         with col3:
-            st.metric("Std Dev", f"{df_clean[display_variable].std():.2f}")
+            st.metric("Std Dev", f"{summary['std']:.2f}")
         with col4:
             st.metric("Countries", len(df_clean))
 
@@ -430,8 +683,8 @@ if check_password():
         st.markdown("## 💡 Academic Interpretation")
         
         if not df_clean.empty:
-            max_row = df_clean.loc[df_clean[display_variable].idxmax()]
-            min_row = df_clean.loc[df_clean[display_variable].idxmin()]
+            max_row = df_clean.loc[summary['idxmax']]
+            min_row = df_clean.loc[summary['idxmin']]
 
             if aggregation_method == "Total Sum":
                 interpretation = f"""
@@ -481,9 +734,12 @@ if check_password():
         # ============================================================
         st.markdown("### 🏆 Complete Country Rankings")
         
-        # Create complete ranking
-        df_ranked = df_clean.sort_values(by=display_variable, ascending=False).reset_index(drop=True)
-        df_ranked['Rank'] = range(1, len(df_ranked) + 1)
+        # Create complete ranking on just the columns shown and exported
+        df_ranked = df_clean[['country_name_official', display_variable, 'iso2_label']].sort_values(
+            by=display_variable, ascending=False, ignore_index=True
+        )
+        df_ranked.insert(0, 'Rank', np.arange(1, len(df_ranked) + 1))
+        ranking_columns = ['Rank', 'Country', f"{variable.replace('_', ' ').title()} ({aggregation_method})", 'ISO Code']
         
         # Display options
         col1, col2 = st.columns([3, 1])
@@ -498,45 +754,38 @@ if check_password():
             highlight_top = st.checkbox("Highlight Top 3", value=True)
         
         # Determine how many to show
-        if show_option == "Top 10":
-            df_display = df_ranked.head(10).copy()
-        elif show_option == "Top 20":
-            df_display = df_ranked.head(20).copy()
-        else:
-            df_display = df_ranked.copy()
-        
-        # Create a clean table with formatting
-        display_df = df_display[['Rank', 'country_name_official', display_variable, 'iso2_label']].copy()
-        display_df.columns = ['Rank', 'Country', f"{variable.replace('_', ' ').title()} ({aggregation_method})", 'ISO Code']
-        display_df[display_df.columns[2]] = display_df[display_df.columns[2]].round(3)
+        n_show = {"Top 10": 10, "Top 20": 20}.get(show_option, len(df_ranked))
         
-        # Style the dataframe with highlighting
-        def highlight_ranks(row):
-            if highlight_top and row['Rank'] == 1:
-                return ['background-color: #FFD700; font-weight: bold'] * len(row)  # Gold
-            elif highlight_top and row['Rank'] == 2:
-                return ['background-color: #C0C0C0; font-weight: bold'] * len(row)  # Silver
-            elif highlight_top and row['Rank'] == 3:
-                return ['background-color: #CD7F32; font-weight: bold'] * len(row)  # Bronze
-            else:
-                return [''] * len(row)
+        # Create a clean table with formatting (round() returns the only copy)
+        display_df = df_ranked.head(n_show).round({display_variable: 3})
+        display_df.columns = ranking_columns
         
-        styled_df = display_df.style.apply(highlight_ranks, axis=1)
+        # Style the dataframe with highlighting: one CSS frame built from the
+        # Rank column instead of a Python call per row
+        if highlight_top:
+            row_css = display_df['Rank'].map(RANK_HIGHLIGHTS).fillna('').to_numpy()
+            styled_df = display_df.style.apply(
+                lambda table: pd.DataFrame(
+                    np.repeat(row_css[:, None], table.shape[1], axis=1),
+                    index=table.index, columns=table.columns
+                ),
+                axis=None
+            )
+        else:
+            styled_df = display_df
         
         st.dataframe(styled_df, hide_index=True, use_container_width=True, height=400)
         
         # Summary stats below table
         st.markdown(f"""
-        **Table Summary:** Showing {len(df_display)} of {len(df_ranked)} countries ranked by {variable.replace('_', ' ')} ({aggregation_method.lower()}).
+        **Table Summary:** Showing {len(display_df)} of {len(df_ranked)} countries ranked by {variable.replace('_', ' ')} ({aggregation_method.lower()}).
         """)
 
         # Show bottom 5 in an expander
         if len(df_ranked) > 10:
             with st.expander("📉 View Bottom 5 Countries"):
-                df_bottom = df_ranked.tail(5).copy()
-                bottom_display = df_bottom[['Rank', 'country_name_official', display_variable, 'iso2_label']].copy()
-                bottom_display.columns = ['Rank', 'Country', f"{variable.replace('_', ' ').title()} ({aggregation_method})", 'ISO Code']
-                bottom_display[bottom_display.columns[2]] = bottom_display[bottom_display.columns[2]].round(3)
+                bottom_display = df_ranked.tail(5).round({display_variable: 3})
+                bottom_display.columns = ranking_columns
                 st.dataframe(bottom_display, hide_index=True, use_container_width=True)
 
         # ============================================================
@@ -544,90 +793,66 @@ if check_password():
         # ============================================================
         st.markdown("### 📊 Visual Comparison")
         
-        # Create tabs for different visualizations
-        tab1, tab2 = st.tabs(["📊 Horizontal Bar Chart", "📈 Distribution Plot"])
+        # Create tabs for different visualizations; on_change="rerun" makes them
+        # stateful, so only the selected tab's chart is built and sent
+        tab1, tab2 = st.tabs(["📊 Horizontal Bar Chart", "📈 Distribution Plot"],
+                             key="chart_tabs", on_change="rerun")
         
         with tab1:
-            # Horizontal bar chart for top countries
-            n_bars = min(15, len(df_ranked))
-            df_for_bar = df_ranked.head(n_bars).copy()
-            
-            fig_bar = px.bar(
-                df_for_bar,
-                y='country_name_official',
-                x=display_variable,
-                orientation='h',
-                color=display_variable,
-                color_continuous_scale=color_scheme,
-                labels={display_variable: f"{variable.replace('_', ' ').title()} ({aggregation_method})",
-                       'country_name_official': 'Country'},
-                text=display_variable
-            )
-            
-            fig_bar.update_traces(texttemplate='%{text:.2f}', textposition='outside')
-            fig_bar.update_layout(
-                yaxis={'categoryorder': 'total ascending'},
-                height=max(400, n_bars * 30),
-                showlegend=False,
-                title={'text': f'Top {n_bars} Countries by {variable.replace("_", " ").title()} ({aggregation_method})',
-                      'x': 0.5, 'xanchor': 'center'},
-                xaxis_title=f"{variable.replace('_', ' ').title()} ({aggregation_method})",
-                yaxis_title=''
-            )
-            
-            st.plotly_chart(fig_bar, use_container_width=True)
+            if tab1.open:
+                # Horizontal bar chart for top countries
+                n_bars = min(15, len(df_ranked))
+                df_for_bar = df_ranked.head(n_bars)
+                
+                fig_bar = go.Figure(build_bar_chart(
+                    tuple(df_for_bar['country_name_official']),
+                    tuple(df_for_bar[display_variable]),
+                    value_label,
+                    color_scheme,
+                    f'Top {n_bars} Countries by {value_label}'
+                ))
+                
+                st.plotly_chart(fig_bar, use_container_width=True)
         
         with tab2:
-            # Distribution histogram
-            fig_hist = px.histogram(
-                df_ranked,
-                x=display_variable,
-                nbins=30,
-                color_discrete_sequence=['#636EFA'],
-                labels={display_variable: f"{variable.replace('_', ' ').title()} ({aggregation_method})"}
-            )
-            
-            fig_hist.update_layout(
-                title={'text': f'Distribution of {variable.replace("_", " ").title()} ({aggregation_method}) Across Countries',
-                      'x': 0.5, 'xanchor': 'center'},
-                xaxis_title=f"{variable.replace('_', ' ').title()} ({aggregation_method})",
-                yaxis_title='Frequency (Number of Countries)',
-                height=400,
-                showlegend=False
-            )
-            
-            # Add vertical lines for mean and median
-            mean_val = df_ranked[display_variable].mean()
-            median_val = df_ranked[display_variable].median()
-            
-            fig_hist.add_vline(x=mean_val, line_dash="dash", line_color="red", 
-                              annotation_text=f"Mean: {mean_val:.2f}", 
-                              annotation_position="top")
-            fig_hist.add_vline(x=median_val, line_dash="dash", line_color="green", 
-                              annotation_text=f"Median: {median_val:.2f}", 
-                              annotation_position="bottom")
-            
-            st.plotly_chart(fig_hist, use_container_width=True)
+            if tab2.open:
+                # Distribution histogram
+                fig_hist = go.Figure(build_histogram(
+                    tuple(df_ranked[display_variable]),
+                    display_variable,
+                    value_label,
+                    f'Distribution of {value_label} Across Countries'
+                ))
+                
+                st.plotly_chart(fig_hist, use_container_width=True)
 
         st.markdown("---")
 
         # ============================================================
         # COUNTRY CODE LEGEND
         # ============================================================
-        with st.expander("🗺️ Country Code Reference Guide"):
-            st.markdown("**ISO-2 to Country Name Mapping**")
-            
-            legend_df = df_clean[["iso2_label", "country_name_official"]].drop_duplicates(
-                subset=["iso2_label"]
-            ).sort_values(by="country_name_official")
-            
-            # Create multi-column layout for legend
-            n_cols = 3
-            cols = st.columns(n_cols)
-            
-            for idx, (_, row) in enumerate(legend_df.iterrows()):
-                col_idx = idx % n_cols
-                cols[col_idx].write(f"**{row['iso2_label']}**: {row['country_name_official']}")
+        # on_change="rerun" makes the expander stateful, so the legend is only
+        # built and sent to the browser while it is open
+        code_guide = st.expander("🗺️ Country Code Reference Guide", key="code_guide", on_change="rerun")
+        with code_guide:
+            if code_guide.open:
+                st.markdown("**ISO-2 to Country Name Mapping**")
+                
+                legend_df = df_clean[["iso2_label", "country_name_official"]].drop_duplicates(
+                    subset=["iso2_label"]
+                ).sort_values(by="country_name_official")
+                
+                # Three-column CSS grid emitted as one element instead of one write per country
+                iso2_codes = legend_df["iso2_label"].to_numpy()
+                country_names = legend_df["country_name_official"].to_numpy()
+                items = "".join(
+                    f"<div><b>{html.escape(code)}</b>: {html.escape(name)}</div>"
+                    for code, name in zip(iso2_codes, country_names)
+                )
+                st.markdown(
+                    f"<div style='display: grid; grid-template-columns: repeat(3, 1fr); gap: 6px;'>{items}</div>",
+                    unsafe_allow_html=True
+                )
 
         # ============================================================
         # DOWNLOAD OPTIONS
@@ -637,24 +862,26 @@ if check_password():
         
         col1, col2 = st.columns(2)
         
+        # CSVs are generated only when a button is clicked, and downloading
+        # doesn't rerun the script
         with col1:
             # Download cleaned data
-            csv = df_clean.to_csv(index=False).encode('utf-8')
             st.download_button(
                 label="📥 Download Cleaned Data (CSV)",
-                data=csv,
+                data=partial(to_csv_bytes, df_clean),
                 file_name=f"spatial_data_{variable}_{aggregation_method.replace(' ', '_')}.csv",
-                mime="text/csv"
+                mime="text/csv",
+                on_click="ignore"
             )
         
         with col2:
             # Download rankings (complete)
-            ranking_csv = df_ranked[['Rank', 'country_name_official', display_variable, 'iso2_label']].to_csv(index=False).encode('utf-8')
             st.download_button(
                 label="📥 Download Complete Rankings (CSV)",
-                data=ranking_csv,
+                data=partial(to_csv_bytes, df_ranked),
                 file_name=f"complete_rankings_{variable}_{aggregation_method.replace(' ', '_')}.csv",
-                mime="text/csv"
+                mime="text/csv",
+                on_click="ignore"
             )
 
         # Footer